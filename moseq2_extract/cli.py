@@ -378,6 +378,12 @@ This is only a debugging parameter, for cases where dilate_iterations > 1, other
         type=int,
         help="Frames overlapped in each chunk. Useful for cable tracking",
     )(function)
+    function = click.option(
+        "--num-workers",
+        default=1,
+        type=int,
+        help="Number of processes extracting batches in parallel. Not used with the tracking model",
+    )(function)
     function = click.option(
         "--write-movie",
         default=True,
@@ -5,11 +5,15 @@ Extraction helper utility for computing scalar feature values performing cleanin
 import cv2
 import numpy as np
 from copy import deepcopy
+from tqdm.auto import tqdm
 from moseq2_extract.extract.track import em_tracking, em_get_ll
 from moseq2_extract.extract.proc import (
     crop_and_rotate_frames,
     threshold_chunk,
+    preprocess_chunk,
+    crop_roi,
     clean_frames,
+    temporal_filter_frames,
     apply_roi,
     get_frame_features,
     get_flips,
@@ -19,6 +23,62 @@ from moseq2_extract.extract.proc import (
 )
 
 
+def preprocess_tile(
+    chunk,
+    bground=None,
+    roi=None,
+    min_height=10,
+    max_height=100,
+    true_depth=673.1,
+    frame_dtype="uint8",
+    graduate_walls=False,
+    roi_crop=None,
+):
+    """
+    Subtract the background, threshold heights and apply the ROI to a tile of raw depth frames.
+
+    Args:
+    chunk (np.ndarray): raw depth frames to preprocess - (nframes, height, width)
+    bground (np.ndarray): 2D median background image; if None, frames are only ROI-masked.
+    roi (np.ndarray): 2D roi (area of bucket floor) to search for mouse within.
+    min_height (int): minimum (mm) distance of mouse to floor.
+    max_height (int): maximum (mm) distance of mouse to floor.
+    true_depth (float): the computed detected true depth value for the middle of the arena
+    frame_dtype (str): Data type for processed frames
+    graduate_walls (bool): subtract the true depth rather than the background where the mouse is on the bucket edge.
+    roi_crop (tuple): output of crop_roi(roi), computed once for all tiles of a batch.
+
+    Returns:
+    chunk (np.ndarray): preprocessed frames, cropped around the ROI bounding box.
+    """
+
+    if bground is not None and not graduate_walls:
+        # Background subtraction, height thresholding and ROI masking in a single pass
+        return preprocess_chunk(
+            chunk,
+            bground,
+            roi,
+            min_height=min_height,
+            max_height=max_height,
+            frame_dtype=frame_dtype,
+            roi_crop=roi_crop,
+        )
+
+    if bground is not None:
+        # Subtracting only background area where mouse is not on the bucket edge
+        mouse_on_edge = (bground < true_depth) & (chunk < bground)
+        chunk = np.where(mouse_on_edge, true_depth - chunk, bground - chunk)
+
+        # Threshold chunk depth values at min and max heights
+        chunk = threshold_chunk(chunk, min_height, max_height).astype(frame_dtype)
+
+    # Apply ROI mask
+    if roi is not None:
+        chunk = apply_roi(chunk, roi)
+
+    return chunk
+
+
 # one stop shopping for taking some frames and doing stuff
 def extract_chunk(
     chunk,
@@ -55,6 +115,7 @@ def extract_chunk(
     model_smoothing_clips=(-300, -150),
     tracking_model_init="raw",
     compute_raw_scalars=False,
+    tile_size=64,
     **kwargs
 ):
     """
@@ -96,47 +157,60 @@ def extract_chunk(
     model_smoothing_clips (tuple): Model smoothing clips
     tracking_model_init (str): Method for tracking model initialization
     compute_raw_scalars (bool): Compute scalars from unfiltered crop-rotated data.
+    tile_size (int): number of frames per tile in the background subtraction and spatial filtering stages.
 
     Returns:
     results (dict): dict object containing the following keys:
     chunk (numpy.ndarray): bg subtracted and applied ROI version of original video chunk
     depth_frames(numpy.ndarray): cropped and oriented mouse video chunk
     mask_frames (numpy.ndarray): cropped and oriented mouse video chunk
-    scalars (dict): computed scalars (str) mapped to 1d numpy arrays of length=nframes.
+    scalars (numpy.ndarray): computed scalars, a structured array with one field per scalar of length=nframes.
     flips(1d array): list of frame indices where the mouse orientation was flipped.
     parameters (dict): mean and covariance estimates for each frame (if em_tracking=True), otherwise None.
     """
 
-    if bground is not None:
-        # Perform background subtraction
-        if not kwargs.get('graduate_walls', False):
-            # pixels with a value of 0 are depth values that could not be computed
-            chunk = ((bground - chunk) * (chunk != 0)).astype(frame_dtype)
-        else:
-            # Subtracting only background area where mouse is not on the bucket edge
-            mouse_on_edge = (bground < true_depth) & (chunk < bground)
-            chunk = (bground - chunk) * np.logical_not(mouse_on_edge) + (
-                true_depth - chunk
-            ) * mouse_on_edge
+    # The per-frame stages (background subtraction, thresholding, ROI masking and the spatial
+    # filters) run on tiles of tile_size frames so each tile stays in cache across all of them
+    nframes = chunk.shape[0]
+    raw_chunk, chunk, filtered_frames = chunk, None, None
+    roi_crop = crop_roi(roi) if roi is not None else None
+    for start in tqdm(
+        range(0, nframes, tile_size), disable=not progress_bar, desc="Cleaning frames"
+    ):
+        tile = preprocess_tile(
+            raw_chunk[start : start + tile_size],
+            bground,
+            roi,
+            min_height=min_height,
+            max_height=max_height,
+            true_depth=true_depth,
+            frame_dtype=frame_dtype,
+            graduate_walls=kwargs.get("graduate_walls", False),
+            roi_crop=roi_crop,
+        )
 
-        # Threshold chunk depth values at min and max heights
-        chunk = threshold_chunk(chunk, min_height, max_height).astype(frame_dtype)
+        # Denoise the frames before we do anything else
+        filtered_tile = clean_frames(
+            tile,
+            prefilter_space=spatial_filter_size,
+            prefilter_time=None,
+            iters_tail=tail_filter_iters,
+            strel_tail=strel_tail,
+            iters_min=iters_min,
+            strel_min=strel_min,
+            frame_dtype=frame_dtype,
+            progress_bar=False,
+        )
 
-    # Apply ROI mask
-    if roi is not None:
-        chunk = apply_roi(chunk, roi)
+        if chunk is None:
+            chunk = np.empty((nframes,) + tile.shape[1:], tile.dtype)
+            filtered_frames = np.empty((nframes,) + tile.shape[1:], filtered_tile.dtype)
+        chunk[start : start + tile_size] = tile
+        filtered_frames[start : start + tile_size] = filtered_tile
 
-    # Denoise the frames before we do anything else
-    filtered_frames = clean_frames(
-        chunk,
-        prefilter_space=spatial_filter_size,
-        prefilter_time=temporal_filter_size,
-        iters_tail=tail_filter_iters,
-        strel_tail=strel_tail,
-        iters_min=iters_min,
-        strel_min=strel_min,
-        frame_dtype=frame_dtype,
-        progress_bar=progress_bar,
+    # The temporal filter needs neighbouring frames across tiles, so it runs on the whole batch
+    filtered_frames = temporal_filter_frames(
+        filtered_frames, prefilter_time=temporal_filter_size
     )
 
     # If we need it, compute the EM parameters (for tracking in presence of occluders)
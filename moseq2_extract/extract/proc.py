@@ -3,6 +3,7 @@ Video pre-processing utilities for detecting ROIs and extracting raw data.
 """
 
 import cv2
+import numba
 import joblib
 import tarfile
 import scipy.stats
@@ -17,7 +18,7 @@ import moseq2_extract.io.video
 import moseq2_extract.extract.roi
 from os.path import exists, join, dirname
 from moseq2_extract.io.image import read_image, write_image
-from moseq2_extract.util import convert_pxs_to_mm, strided_app
+from moseq2_extract.util import convert_pxs_to_mm, strided_app, scalar_attributes
 
 
 def get_flips(frames, flip_file=None, smoothing=None):
@@ -86,6 +87,38 @@ def get_largest_cc(frames, progress_bar=False):
     return foreground_obj
 
 
+@numba.njit(parallel=True, cache=True)
+def nanmedian_frames(frames):
+    """
+    Compute the per-pixel median of a stack of frames, ignoring NaNs (like np.nanmedian(frames, axis=0)).
+    The median is computed in float64, so it matches np.nanmedian exactly for integer and float64
+    frames; for float32 frames it can differ from np.nanmedian in the last float32 digit.
+    Pixels that are NaN in every frame are NaN in the result.
+
+    Args:
+    frames (numpy.ndarray): frames x rows x columns
+
+    Returns:
+    median (numpy.ndarray): rows x columns median image
+    """
+
+    nframes, rows, cols = frames.shape
+    median = np.empty((rows, cols), np.float64)
+
+    for r in numba.prange(rows):
+        values = np.empty(nframes, np.float64)
+        for c in range(cols):
+            n = 0
+            for i in range(nframes):
+                value = float(frames[i, r, c])
+                if not np.isnan(value):
+                    values[n] = value
+                    n += 1
+            median[r, c] = np.median(values[:n]) if n > 0 else np.nan
+
+    return median
+
+
 def get_bground_im_file(frames_file, frame_stride=500, med_scale=5, output_dir=None, **kwargs):
     """
     Load or compute background from file.
@@ -124,7 +157,7 @@ def get_bground_im_file(frames_file, frame_stride=500, med_scale=5, output_dir=N
                                                           **kwargs).squeeze()
             frame_store.append(cv2.medianBlur(frs, med_scale))
 
-        bground = np.nanmedian(frame_store, axis=0)
+        bground = nanmedian_frames(np.array(frame_store))
 
         write_image(bground_path, bground, scale=True)
     else:
@@ -152,26 +185,127 @@ def get_bbox(roi):
         bbox = np.array([[y.min(), x.min()], [y.max(), x.max()]])
         return bbox
 
+# dtypes cv2.inRange and cv2.bitwise_and handle natively; int64 would come back as int32
+CV2_THRESHOLD_DTYPES = tuple(np.dtype(dtype) for dtype in (
+    'uint8', 'int8', 'uint16', 'int16', 'int32', 'float32', 'float64'))
+
 def threshold_chunk(chunk, min_height, max_height):
     """
     Threshold out depth values that are less than min_height and larger than
-    max_height.
+    max_height. Values outside the range, including NaNs, are set to 0.
+
+    Returns a new array with the same dtype as chunk; chunk itself is not modified.
+    uint8, int8, uint16, int16, int32, float32 and float64 chunks are thresholded with
+    OpenCV, other dtypes with numpy.
 
     Args:
     chunk (np.ndarray): Chunk of frames to threshold (nframes, width, height)
     min_height (int): Minimum depth values to include after thresholding.
     max_height (int): Maximum depth values to include after thresholding.
-    dilate_iterations (int): Number of iterations the ROI was dilated.
 
     Returns:
-    chunk (3D np.ndarray): Updated frame chunk.
+    chunk (3D np.ndarray): Thresholded frame chunk.
     """
 
-    chunk[chunk < min_height] = 0
-    chunk[chunk > max_height] = 0
+    if chunk.dtype not in CV2_THRESHOLD_DTYPES:
+        in_range = (chunk >= min_height) & (chunk <= max_height)
+        return np.where(in_range, chunk, 0).astype(chunk.dtype, copy=False)
+
+    # OpenCV's vectorized range check and masking, applied to the frames stacked as one 2D image
+    frames = chunk.reshape(-1, chunk.shape[-1])
+    in_range = cv2.inRange(frames, min_height, max_height)
+    chunk = cv2.bitwise_and(frames, frames, mask=in_range).reshape(chunk.shape)
 
     return chunk
 
+@numba.njit(parallel=True, cache=True)
+def preprocess_chunk_kernel(chunk, bground, roi_mask, min_height, max_height, out):
+    """
+    Background-subtract, threshold and ROI-mask a chunk of frames in a single pass.
+
+    Args:
+    chunk (np.ndarray): raw depth frames (nframes, rows, cols)
+    bground (np.ndarray): background image (rows, cols)
+    roi_mask (np.ndarray): boolean ROI mask (rows, cols)
+    min_height (int): minimum height (mm) from the floor to keep.
+    max_height (int): maximum height (mm) from the floor to keep.
+    out (np.ndarray): pre-allocated output array with the same shape as chunk.
+
+    Returns:
+    out (np.ndarray): frames of heights from the floor; 0 outside of the ROI and height range.
+    """
+
+    for i in numba.prange(chunk.shape[0]):
+        for r in range(chunk.shape[1]):
+            for c in range(chunk.shape[2]):
+                # pixels with a value of 0 are depth values that could not be computed
+                if chunk[i, r, c] == 0 or not roi_mask[r, c]:
+                    out[i, r, c] = 0
+                    continue
+                # truncate before thresholding, matching a cast to the frame dtype
+                height = np.trunc(bground[r, c] - chunk[i, r, c])
+                if height >= min_height and height <= max_height:
+                    out[i, r, c] = height
+                else:
+                    out[i, r, c] = 0
+
+    return out
+
+
+def crop_roi(roi):
+    """
+    Get the ROI bounding box, as cropped by apply_roi(), and the ROI mask inside it.
+
+    Args:
+    roi (np.ndarray): selected ROI to extract from input images.
+
+    Returns:
+    roi_crop (tuple): row and column slices of the bounding box, and the boolean ROI mask cropped to it.
+    """
+
+    bbox = get_bbox(roi)
+    rows = slice(bbox[0, 0], bbox[1, 0])
+    cols = slice(bbox[0, 1], bbox[1, 1])
+
+    return rows, cols, roi[rows, cols] > 0
+
+
+def preprocess_chunk(chunk, bground, roi=None, min_height=10, max_height=100, frame_dtype='uint8',
+                     roi_crop=None):
+    """
+    Subtract the background, threshold heights and apply the ROI to a chunk of frames.
+
+    Equivalent to background subtraction followed by threshold_chunk() and apply_roi(), but
+    computed in one fused pass over the (ROI-cropped) frames without temporary arrays.
+
+    Args:
+    chunk (np.ndarray): raw depth frames (nframes, rows, cols)
+    bground (np.ndarray): background image (rows, cols)
+    roi (np.ndarray): selected ROI to extract from input images.
+    min_height (int): minimum height (mm) from the floor to keep.
+    max_height (int): maximum height (mm) from the floor to keep.
+    frame_dtype (str): data type of the returned frames.
+    roi_crop (tuple): output of crop_roi(roi); pass it when preprocessing many chunks with the same ROI.
+
+    Returns:
+    out (np.ndarray): background-subtracted frames cropped around the ROI bounding box.
+    """
+
+    if roi_crop is None and roi is not None:
+        roi_crop = crop_roi(roi)
+
+    if roi_crop is not None:
+        rows, cols, roi_mask = roi_crop
+        chunk = chunk[:, rows, cols]
+        bground = bground[rows, cols]
+    else:
+        roi_mask = np.ones(bground.shape, 'bool')
+
+    out = np.empty(chunk.shape, frame_dtype)
+
+    return preprocess_chunk_kernel(chunk, bground, roi_mask, min_height, max_height, out)
+
+
 def get_roi(depth_image,
             strel_dilate=cv2.getStructuringElement(cv2.MORPH_RECT, (15, 15)),
             dilate_iterations=0,
@@ -305,10 +439,19 @@ def apply_roi(frames, roi):
     """
 
     # yeah so fancy indexing slows us down by 3-5x
-    cropped_frames = frames*roi
-    bbox = get_bbox(roi)
+    rows, cols, roi_mask = crop_roi(roi)
+
+    # crop first so only the ROI bounding box gets masked
+    cropped_frames = frames[:, rows, cols]
+
+    if np.issubdtype(cropped_frames.dtype, np.integer):
+        # AND with an all-ones/all-zeros bit mask keeps the frame dtype; no widening multiply
+        dtype = cropped_frames.dtype.type
+        bit_mask = np.where(roi_mask, ~dtype(0), dtype(0))
+        cropped_frames = np.bitwise_and(cropped_frames, bit_mask)
+    else:
+        cropped_frames = cropped_frames * roi[rows, cols]
 
-    cropped_frames = cropped_frames[:, bbox[0, 0]:bbox[1, 0], bbox[0, 1]:bbox[1, 1]]
     return cropped_frames
 
 
@@ -369,7 +512,7 @@ def clean_frames(frames, prefilter_space=(3,), prefilter_time=None,
     """
 
     # seeing enormous speed gains w/ opencv
-    filtered_frames = frames.copy().astype(frame_dtype)
+    filtered_frames = frames.astype(frame_dtype)
 
     for i in tqdm(range(frames.shape[0]), disable=not progress_bar, desc='Cleaning frames'):
         # Erode Frames
@@ -384,11 +527,28 @@ def clean_frames(frames, prefilter_space=(3,), prefilter_time=None,
             filtered_frames[i] = cv2.morphologyEx(filtered_frames[i], cv2.MORPH_OPEN, strel_tail, iters_tail)
 
     # Temporal Median Filter
+    filtered_frames = temporal_filter_frames(filtered_frames, prefilter_time=prefilter_time)
+
+    return filtered_frames
+
+
+def temporal_filter_frames(frames, prefilter_time=None):
+    """
+    Median filter frames over time, with each kernel size in prefilter_time applied in turn.
+
+    Args:
+    frames (numpy.ndarray): frames x rows x columns
+    prefilter_time (tuple): kernel sizes for temporal filtering
+
+    Returns:
+    frames (numpy.ndarray): filtered frames x rows x columns
+    """
+
     if prefilter_time is not None and np.all(np.array(prefilter_time) > 0):
         for j in range(len(prefilter_time)):
-            filtered_frames = scipy.signal.medfilt(filtered_frames, [prefilter_time[j], 1, 1])
+            frames = scipy.signal.medfilt(frames, [prefilter_time[j], 1, 1])
 
-    return filtered_frames
+    return frames
 
 
 def get_frame_features(frames, frame_threshold=10, mask=np.array([]),
@@ -522,31 +682,14 @@ def compute_scalars(frames, track_features, min_height=10, max_height=100, true_
     true_depth (float): detected true depth
 
     Returns:
-    features (dict): dictionary of scalars
+    features (numpy.ndarray): structured array of scalars, one field per scalar
     """
 
     nframes = frames.shape[0]
 
-    # Pack features into dict
-    features = {
-        'centroid_x_px': np.zeros((nframes,), 'float32'),
-        'centroid_y_px': np.zeros((nframes,), 'float32'),
-        'velocity_2d_px': np.zeros((nframes,), 'float32'),
-        'velocity_3d_px': np.zeros((nframes,), 'float32'),
-        'width_px': np.zeros((nframes,), 'float32'),
-        'length_px': np.zeros((nframes,), 'float32'),
-        'area_px': np.zeros((nframes,)),
-        'centroid_x_mm': np.zeros((nframes,), 'float32'),
-        'centroid_y_mm': np.zeros((nframes,), 'float32'),
-        'velocity_2d_mm': np.zeros((nframes,), 'float32'),
-        'velocity_3d_mm': np.zeros((nframes,), 'float32'),
-        'width_mm': np.zeros((nframes,), 'float32'),
-        'length_mm': np.zeros((nframes,), 'float32'),
-        'area_mm': np.zeros((nframes,)),
-        'height_ave_mm': np.zeros((nframes,), 'float32'),
-        'angle': np.zeros((nframes,), 'float32'),
-        'velocity_theta': np.zeros((nframes,)),
-    }
+    # Pack features into one float32 record per frame, with fields in scalar_attributes() order;
+    # field views behave like the per-scalar arrays, and the batch is one contiguous slab
+    features = np.zeros((nframes,), [(scalar, 'float32') for scalar in scalar_attributes()])
 
     # Get mm centroid
     centroid_mm = convert_pxs_to_mm(track_features['centroid'], true_depth=true_depth)
@@ -556,21 +699,27 @@ def compute_scalars(frames, track_features, min_height=10, max_height=100, true_
     px_to_mm = np.abs(centroid_mm_shift - centroid_mm)
     masked_frames = np.logical_and(frames > min_height, frames < max_height)
 
-    features['centroid_x_px'] = track_features['centroid'][:, 0]
-    features['centroid_y_px'] = track_features['centroid'][:, 1]
+    # derived scalars are computed from these full-precision values, not the float32 fields
+    centroid_px = track_features['centroid']
+    width_px = np.min(track_features['axis_length'], axis=1)
+    length_px = np.max(track_features['axis_length'], axis=1)
+    area_px = np.sum(masked_frames, axis=(1, 2))
+
+    features['centroid_x_px'] = centroid_px[:, 0]
+    features['centroid_y_px'] = centroid_px[:, 1]
 
     features['centroid_x_mm'] = centroid_mm[:, 0]
     features['centroid_y_mm'] = centroid_mm[:, 1]
 
     # based on the centroid of the mouse, get the mm_to_px conversion
 
-    features['width_px'] = np.min(track_features['axis_length'], axis=1)
-    features['length_px'] = np.max(track_features['axis_length'], axis=1)
-    features['area_px'] = np.sum(masked_frames, axis=(1, 2))
+    features['width_px'] = width_px
+    features['length_px'] = length_px
+    features['area_px'] = area_px
 
-    features['width_mm'] = features['width_px'] * px_to_mm[:, 1]
-    features['length_mm'] = features['length_px'] * px_to_mm[:, 0]
-    features['area_mm'] = features['area_px'] * px_to_mm.mean(axis=1)
+    features['width_mm'] = width_px * px_to_mm[:, 1]
+    features['length_mm'] = length_px * px_to_mm[:, 0]
+    features['area_mm'] = area_px * px_to_mm.mean(axis=1)
 
     features['angle'] = track_features['orientation']
 
@@ -581,16 +730,16 @@ def compute_scalars(frames, track_features, min_height=10, max_height=100, true_
             features['height_ave_mm'][i] = np.mean(
                 frames[i, masked_frames[i]])
 
-    vel_x = np.diff(np.concatenate((features['centroid_x_px'][:1], features['centroid_x_px'])))
-    vel_y = np.diff(np.concatenate((features['centroid_y_px'][:1], features['centroid_y_px'])))
+    vel_x = np.diff(np.concatenate((centroid_px[:1, 0], centroid_px[:, 0])))
+    vel_y = np.diff(np.concatenate((centroid_px[:1, 1], centroid_px[:, 1])))
     vel_z = np.diff(np.concatenate((features['height_ave_mm'][:1], features['height_ave_mm'])))
 
     features['velocity_2d_px'] = np.hypot(vel_x, vel_y)
     features['velocity_3d_px'] = np.sqrt(
         np.square(vel_x)+np.square(vel_y)+np.square(vel_z))
 
-    vel_x = np.diff(np.concatenate((features['centroid_x_mm'][:1], features['centroid_x_mm'])))
-    vel_y = np.diff(np.concatenate((features['centroid_y_mm'][:1], features['centroid_y_mm'])))
+    vel_x = np.diff(np.concatenate((centroid_mm[:1, 0], centroid_mm[:, 0])))
+    vel_y = np.diff(np.concatenate((centroid_mm[:1, 1], centroid_mm[:, 1])))
 
     features['velocity_2d_mm'] = np.hypot(vel_x, vel_y)
     features['velocity_3d_mm'] = np.sqrt(
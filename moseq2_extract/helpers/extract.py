@@ -2,8 +2,18 @@
 Extraction-helper utility functions.
 """
 
+import queue
+import blosc
+import numba
+import tarfile
+import threading
+import hdf5plugin
 import numpy as np
+import multiprocessing
 import ruamel.yaml as yaml
+from collections import deque
+from numpy.lib.recfunctions import structured_to_unstructured
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from os.path import exists, basename, dirname, join, abspath
 from os import makedirs, system
 from tqdm.auto import tqdm
@@ -12,36 +22,126 @@ from moseq2_extract.util import read_yaml
 from moseq2_extract.io.video import load_movie_data, write_frames_preview
 from moseq2_extract.helpers.data import check_completion_status
 
+# compressor names indexed by the compressor code stored in the hdf5 Blosc filter settings
+BLOSC_COMPRESSORS = ("blosclz", "lz4", "lz4hc", "snappy", "zlib", "zstd")
+
+
+def get_extract_datasets(h5_file, config_data):
+    """
+    Look up the h5 datasets written to for every extracted batch, so the per-batch writes
+    index the dataset handles directly instead of resolving their paths each time.
+
+    Args:
+    h5_file (h5py.File): open results_00 h5 file created by create_extract_h5().
+    config_data (dict): dictionary containing extraction parameters (autogenerated)
+
+    Returns:
+    h5_datasets (dict): dict of h5py.Dataset handles keyed by packed_scalars, frames, frames_mask
+     and, if the flip classifier is used, flips.
+    """
+
+    h5_datasets = {
+        "packed_scalars": h5_file["packed_scalars"],
+        "frames": h5_file["frames"],
+        "frames_mask": h5_file["frames_mask"],
+    }
+    if config_data["flip_classifier"]:
+        h5_datasets["flips"] = h5_file["metadata/extraction/flips"]
+
+    return h5_datasets
+
+
+def write_batch_to_dataset(dset, frame_range, data):
+    """
+    Write a batch of rows to an h5 dataset. A batch that covers exactly one chunk of a
+    Blosc-compressed dataset (every batch when chunk_overlap is 0, see create_extract_h5())
+    is compressed here and stored with write_direct_chunk, skipping h5py's type conversion
+    and the HDF5 filter pipeline. Any other write falls back to slice assignment.
+
+    Args:
+    dset (h5py.Dataset): dataset to write to
+    frame_range (range object): dataset rows to write
+    data (numpy.ndarray): rows to write, one per index in frame_range
+
+    Returns:
+    """
+
+    blosc_filter = None
+    if dset.chunks is not None and tuple(dset.chunks[1:]) == dset.shape[1:]:
+        blosc_filter = dset.id.get_create_plist().get_filter_by_id(hdf5plugin.BLOSC_ID)
+
+    chunk_rows = dset.chunks[0] if dset.chunks is not None else 0
+    aligned = (
+        blosc_filter is not None
+        and len(blosc_filter[1]) >= 7
+        and isinstance(frame_range, range)
+        and len(frame_range) > 0
+        and frame_range.step == 1
+        and frame_range.start % chunk_rows == 0
+        and frame_range.stop <= dset.shape[0]
+        and (len(frame_range) == chunk_rows or frame_range.stop == dset.shape[0])
+    )
+    if not aligned:
+        dset[frame_range] = data
+        return
+
+    if len(frame_range) == chunk_rows:
+        chunk = np.ascontiguousarray(data, dtype=dset.dtype)
+    else:
+        # the last chunk of a dataset is stored full size, so pad it with the fill value
+        chunk = np.zeros(dset.chunks, dset.dtype)
+        chunk[: len(frame_range)] = data
+
+    clevel, shuffle, compressor = blosc_filter[1][4:7]
+    compressed = blosc.compress_ptr(
+        chunk.__array_interface__["data"][0],
+        chunk.size,
+        typesize=chunk.itemsize,
+        clevel=clevel,
+        shuffle=shuffle,
+        cname=BLOSC_COMPRESSORS[compressor],
+    )
+    dset.id.write_direct_chunk((frame_range.start,) + (0,) * (dset.ndim - 1), compressed)
+
 
 def write_extracted_chunk_to_h5(
-    h5_file, results, config_data, scalars, frame_range, offset
+    h5_datasets, results, config_data, scalars, frame_range, offset
 ):
     """
 
     Write extracted frames, frame masks, and scalars to an open h5 file.
 
     Args:
-    h5_file (H5py.File): open results_00 h5 file to save data in.
+    h5_datasets (dict): dataset handles of the open results_00 h5 file; output of get_extract_datasets().
     results (dict): extraction results dict.
     config_data (dict): dictionary containing extraction parameters (autogenerated)
-    scalars (list): list of keys to scalar attribute values
+    scalars (list): list of keys to scalar attribute values, in packed_scalars column order
     frame_range (range object): current chunk frame range
     offset (int): frame offset
 
     Returns:
     """
 
-    # Writing computed scalars to h5 file
-    for scalar in scalars:
-        h5_file[f"scalars/{scalar}"][frame_range] = results["scalars"][scalar][offset:]
+    # Writing computed scalars to h5 file in a single (nframes x nscalars) slab
+    write_batch_to_dataset(
+        h5_datasets["packed_scalars"],
+        frame_range,
+        structured_to_unstructured(results["scalars"][scalars][offset:]),
+    )
 
     # Writing frames and mask to h5
-    h5_file["frames"][frame_range] = results["depth_frames"][offset:]
-    h5_file["frames_mask"][frame_range] = results["mask_frames"][offset:]
+    write_batch_to_dataset(
+        h5_datasets["frames"], frame_range, results["depth_frames"][offset:]
+    )
+    write_batch_to_dataset(
+        h5_datasets["frames_mask"], frame_range, results["mask_frames"][offset:]
+    )
 
     # Writing flip classifier results to h5
     if config_data["flip_classifier"]:
-        h5_file["metadata/extraction/flips"][frame_range] = results["flips"][offset:]
+        write_batch_to_dataset(
+            h5_datasets["flips"], frame_range, results["flips"][offset:]
+        )
 
 
 def set_tracking_model_parameters(
@@ -77,7 +177,7 @@ def set_tracking_model_parameters(
     return results, tracking_init_mean, tracking_init_cov
 
 
-def make_output_movie(results, config_data, offset=0):
+def make_output_movie(results, config_data, offset=0, output_movie=None):
     """
     Create an array for output movie with filtered video and cropped mouse on the top left
 
@@ -85,31 +185,210 @@ def make_output_movie(results, config_data, offset=0):
     results (dict): dict of extracted depth frames, and original raw chunk to create an output movie.
     config_data (dict): dict of extraction parameters containing the crop sizes used in the extraction.
     offset (int): current offset being used, automatically set if chunk_overlap > 0
+    output_movie (numpy.ndarray): output movie array from a previous batch to reuse, if it is large enough.
 
     Returns:
     output_movie (numpy.ndarray): output movie to write to mp4 file.
     """
 
-    # Create empty array for output movie with filtered video and cropped mouse on the top left
+    crop_rows, crop_cols = config_data["crop_size"]
     nframes, rows, cols = results["chunk"][offset:].shape
-    output_movie = np.zeros(
-        (
-            nframes,
-            rows + config_data["crop_size"][0],
-            cols + config_data["crop_size"][1],
-        ),
-        "uint16",
-    )
+    frame_shape = (rows + crop_rows, cols + crop_cols)
+    # keep the frames' own dtype (uint8 by default) rather than widening to uint16
+    dtype = np.result_type(results["depth_frames"], results["chunk"])
+
+    # Only allocate when there is no reusable array. The regions outside the two tiles are
+    # zeroed here once and never written, so they stay blank across batches.
+    if (
+        output_movie is None
+        or output_movie.shape[1:] != frame_shape
+        or output_movie.dtype != dtype
+        or len(output_movie) < nframes
+    ):
+        output_movie = np.zeros((nframes,) + frame_shape, dtype)
+    output_movie = output_movie[:nframes]
 
     # Populating array with filtered and cropped videos
-    output_movie[:, : config_data["crop_size"][0], : config_data["crop_size"][1]] = (
-        results["depth_frames"][offset:]
+    output_movie[:, :crop_rows, :crop_cols] = results["depth_frames"][offset:]
+    output_movie[:, crop_rows:, crop_cols:] = results["chunk"][offset:]
+
+    return output_movie
+
+
+def load_and_extract_chunk(input_file, frame_range, config_data, bground_im, roi, str_els):
+    """
+    Load a batch of frames from the depth file and extract it. Run by the worker processes of
+    extract_batches_in_parallel().
+
+    Args:
+    input_file (str): path to depth file
+    frame_range (range object): frame indices of the batch to extract
+    config_data (dict): dictionary containing extraction parameters (autogenerated)
+    bground_im (numpy.ndarray): background image
+    roi (numpy.ndarray): roi image
+    str_els (dict): dictionary containing OpenCV StructuringElements
+
+    Returns:
+    results (dict): extraction results dict; output of extract_chunk().
+    """
+
+    raw_chunk = load_movie_data(
+        input_file, frame_range, frame_size=bground_im.shape[::-1], **config_data
     )
-    output_movie[:, config_data["crop_size"][0] :, config_data["crop_size"][1] :] = (
-        results["chunk"][offset:]
+
+    return extract_chunk(
+        **config_data, **str_els, chunk=raw_chunk, roi=roi, bground=bground_im
     )
 
-    return output_movie
+
+def extract_batches_in_parallel(
+    input_file, frame_batches, config_data, bground_im, roi, str_els, num_workers
+):
+    """
+    Extract independent frame batches in worker processes, yielding the results in batch order.
+
+    Only valid when the EM tracking model is not used, since the tracking model carries its
+    estimates over from one batch to the next.
+
+    Args:
+    input_file (str): path to depth file
+    frame_batches (iterable): batches of frames to process.
+    config_data (dict): dictionary containing extraction parameters (autogenerated)
+    bground_im (numpy.ndarray): background image
+    roi (numpy.ndarray): roi image
+    str_els (dict): dictionary containing OpenCV StructuringElements
+    num_workers (int): number of worker processes.
+
+    Yields:
+    (frame_range, results) (tuple): batch frame range and its extract_chunk() results.
+    """
+
+    # spawned workers do not inherit numba's thread pool from this process, and each worker's
+    # numba kernels get an even share of it; set_num_threads rejects more threads than
+    # NUMBA_NUM_THREADS, which can be lower than the core count
+    with ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=numba.set_num_threads,
+        initargs=(max(1, numba.config.NUMBA_NUM_THREADS // num_workers),),
+    ) as executor:
+        # bound the number of submitted batches so finished results can't pile up in memory
+        pending = deque()
+        try:
+            for frame_range in frame_batches:
+                future = executor.submit(
+                    load_and_extract_chunk,
+                    input_file,
+                    frame_range,
+                    config_data,
+                    bground_im,
+                    roi,
+                    str_els,
+                )
+                pending.append((frame_range, future))
+                if len(pending) > num_workers:
+                    frame_range, future = pending.popleft()
+                    yield frame_range, future.result()
+
+            while len(pending) > 0:
+                frame_range, future = pending.popleft()
+                yield frame_range, future.result()
+        finally:
+            # when the caller stops early, drop the batches that haven't started yet
+            for _, future in pending:
+                future.cancel()
+
+
+def prefetch_batches(input_file, frame_batches, config_data, frame_size):
+    """
+    Load frame batches from the depth file on a background thread, one batch ahead of the
+    caller, so reading and decoding the next batch overlaps with extracting the current one.
+
+    Args:
+    input_file (str): path to depth file
+    frame_batches (iterable): batches of frames to load.
+    config_data (dict): dictionary containing extraction parameters (autogenerated)
+    frame_size (tuple): dimensions of the depth frames (width, height)
+
+    Yields:
+    (frame_range, raw_chunk) (tuple): batch frame range and its loaded depth frames.
+    """
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        pending = None
+        for frame_range in frame_batches:
+            # submit the next load before handing out the previous batch
+            future = executor.submit(
+                load_movie_data,
+                input_file,
+                frame_range,
+                frame_size=frame_size,
+                **config_data,
+            )
+            if pending is not None:
+                yield pending[0], pending[1].result()
+            pending = (frame_range, future)
+
+        if pending is not None:
+            yield pending[0], pending[1].result()
+
+
+def write_extracted_batches(
+    write_queue, h5_datasets, config_data, scalars, output_mov_path, writer_state
+):
+    """
+    Write extracted batches popped from a queue to the h5 file and the preview movie.
+
+    Runs on a background thread so h5 compression and ffmpeg piping overlap with the
+    extraction of the next batch.
+
+    Args:
+    write_queue (queue.Queue): queue of (results, frame_range, offset) tuples; None ends the writer.
+    h5_datasets (dict): dataset handles of the h5 file to write extracted batches to, or None
+    config_data (dict): dictionary containing extraction parameters (autogenerated)
+    scalars (list): list of keys to scalar attribute values
+    output_mov_path (str): path and filename of the output movie generated by the extraction
+    writer_state (dict): holds the open preview video pipe and any exception raised while writing.
+
+    Returns:
+    """
+
+    output_movie = None
+    while True:
+        batch = write_queue.get()
+        if batch is None:
+            break
+
+        # keep draining the queue after a failure so the extraction loop never blocks on put()
+        if writer_state["error"] is not None:
+            continue
+
+        results, frame_range, offset = batch
+        try:
+            if h5_datasets is not None:
+                write_extracted_chunk_to_h5(
+                    h5_datasets, results, config_data, scalars, frame_range, offset
+                )
+
+            # Create array for output movie with filtered video and cropped mouse on the top left
+            output_movie = make_output_movie(
+                results, config_data, offset, output_movie=output_movie
+            )
+
+            # Writing frame batch to mp4 file
+            writer_state["video_pipe"] = write_frames_preview(
+                output_mov_path,
+                output_movie,
+                pipe=writer_state["video_pipe"],
+                close_pipe=False,
+                fps=config_data["fps"],
+                frame_range=frame_range,
+                depth_max=config_data["max_height"],
+                depth_min=config_data["min_height"],
+                progress_bar=config_data.get("progress_bar", False),
+            )
+        except Exception as e:
+            writer_state["error"] = e
 
 
 def process_extract_batches(
@@ -123,6 +402,7 @@ def process_extract_batches(
     scalars=None,
     h5_file=None,
     video_pipe=None,
+    n_batches=None,
     **kwargs,
 ):
     """
@@ -133,71 +413,116 @@ def process_extract_batches(
     config_data (dict): dictionary containing extraction parameters (autogenerated)
     bground_im (numpy.ndarray):  background image
     roi (numpy.ndarray): roi image
-    frame_batches (list): list of batches of frames to serially process.
+    frame_batches (iterable): batches of frames to process, e.g. from gen_batch_sequence().
     str_els (dict): dictionary containing OpenCV StructuringElements
     output_mov_path (str): path and filename of the output movie generated by the extraction
     scalars (list): list of keys to scalar attribute values
     h5file (h5py.File): opened h5 file to write extracted batches to
     video_pipe (subprocess.PIPE): open pipe to location where preview extraction is being written.
+    n_batches (int): number of batches in frame_batches, for the progress bar; defaults to len(frame_batches).
     kwargs (dict): Extra keyword arguments.
 
     Returns:
     """
 
+    if n_batches is None and hasattr(frame_batches, "__len__"):
+        n_batches = len(frame_batches)
+
     tracking_init_mean = config_data.pop("tracking_init_mean", None)
     tracking_init_cov = config_data.pop("tracking_init_cov", None)
 
-    for i, frame_range in enumerate(tqdm(frame_batches, desc="Processing batches")):
-        raw_chunk = load_movie_data(
-            input_file, frame_range, frame_size=bground_im.shape[::-1], **config_data
-        )
+    # Extracted batches are written on a separate thread; the bounded queue caps how many
+    # finished batches can wait in memory for the writer.
+    writer_state = {"video_pipe": video_pipe, "error": None}
+    h5_datasets = (
+        get_extract_datasets(h5_file, config_data) if h5_file is not None else None
+    )
+    write_queue = queue.Queue(maxsize=2)
+    writer = threading.Thread(
+        target=write_extracted_batches,
+        args=(
+            write_queue,
+            h5_datasets,
+            config_data,
+            scalars,
+            output_mov_path,
+            writer_state,
+        ),
+        daemon=True,
+    )
+    writer.start()
+
+    # Batches only depend on each other through the tracking model, so without it they can be
+    # extracted in parallel worker processes (tar archives can't be shared between processes)
+    num_workers = config_data.get("num_workers", 1) or 1
+    use_workers = (
+        num_workers > 1
+        and not config_data["use_tracking_model"]
+        and type(input_file) is not tarfile.TarFile
+    )
 
-        offset = config_data["chunk_overlap"] if i > 0 else 0
-
-        # Get crop-rotated frame batch
-        results = extract_chunk(
-            **config_data,
-            **str_els,
-            chunk=raw_chunk,
-            roi=roi,
-            bground=bground_im,
-            tracking_init_mean=tracking_init_mean,
-            tracking_init_cov=tracking_init_cov,
+    if use_workers:
+        batches = extract_batches_in_parallel(
+            input_file,
+            frame_batches,
+            config_data,
+            bground_im,
+            roi,
+            str_els,
+            num_workers,
         )
-
-        if config_data["use_tracking_model"]:
-            # threshold and clip mask frames from EM tracking results
-            results, tracking_init_mean, tracking_init_cov = (
-                set_tracking_model_parameters(results, **config_data)
-            )
-
-        # Offsetting frame chunk by CLI parameter defined option: chunk_overlap
-        frame_range = frame_range[offset:]
-
-        if h5_file is not None:
-            write_extracted_chunk_to_h5(
-                h5_file, results, config_data, scalars, frame_range, offset
-            )
-
-        # Create array for output movie with filtered video and cropped mouse on the top left
-        output_movie = make_output_movie(results, config_data, offset)
-
-        # Writing frame batch to mp4 file
-        video_pipe = write_frames_preview(
-            output_mov_path,
-            output_movie,
-            pipe=video_pipe,
-            close_pipe=False,
-            fps=config_data["fps"],
-            frame_range=list(frame_range),
-            depth_max=config_data["max_height"],
-            depth_min=config_data["min_height"],
-            progress_bar=config_data.get("progress_bar", False),
+    else:
+        batches = prefetch_batches(
+            input_file, frame_batches, config_data, bground_im.shape[::-1]
         )
 
-    # Check if video is done writing. If not, wait.
-    if video_pipe is not None:
-        video_pipe.communicate()
+    try:
+        for i, (frame_range, batch) in enumerate(
+            tqdm(batches, total=n_batches, desc="Processing batches")
+        ):
+            # stop extracting as soon as the writer fails; nothing more would be written
+            if writer_state["error"] is not None:
+                break
+
+            offset = config_data["chunk_overlap"] if i > 0 else 0
+
+            if use_workers:
+                results = batch
+            else:
+                # Get crop-rotated frame batch
+                results = extract_chunk(
+                    **config_data,
+                    **str_els,
+                    chunk=batch,
+                    roi=roi,
+                    bground=bground_im,
+                    tracking_init_mean=tracking_init_mean,
+                    tracking_init_cov=tracking_init_cov,
+                )
+
+            if config_data["use_tracking_model"]:
+                # threshold and clip mask frames from EM tracking results
+                results, tracking_init_mean, tracking_init_cov = (
+                    set_tracking_model_parameters(results, **config_data)
+                )
+
+            # Offsetting frame chunk by CLI parameter defined option: chunk_overlap
+            frame_range = frame_range[offset:]
+
+            write_queue.put((results, frame_range, offset))
+    finally:
+        # stops any batches still being loaded or extracted in the background
+        batches.close()
+        write_queue.put(None)
+        writer.join()
+
+        # Check if video is done writing. If not, wait. Also runs when the extraction
+        # stops early, so the ffmpeg process is not left behind.
+        if writer_state["video_pipe"] is not None:
+            writer_state["video_pipe"].communicate()
+
+    if writer_state["error"] is not None:
+        raise writer_state["error"]
 
 
 def run_local_extract(to_extract, config_file, skip_extracted=False):
@@ -235,8 +560,7 @@ def run_slurm_extract(input_dir, to_extract, config_data, skip_extracted=False):
             output_dir = join(dirname(depth_file), config_data["output_dir"])
 
             # ensure output_dir exists
-            if not exists(output_dir):
-                makedirs(output_dir)
+            makedirs(output_dir, exist_ok=True)
 
             # get and write session-specific parameters
             output_file = join(output_dir, "config.yaml")
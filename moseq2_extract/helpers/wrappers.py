@@ -34,6 +34,7 @@ from moseq2_extract.helpers.data import (
 from moseq2_extract.util import (
     select_strel,
     gen_batch_sequence,
+    count_batches,
     scalar_attributes,
     convert_raw_to_avi_function,
     set_bground_to_plane_fit,
@@ -449,13 +450,19 @@ def extract_wrapper(input_file, output_dir, config_data, num_frames=None, skip=F
     scalars_attrs = scalar_attributes()
     scalars = list(scalars_attrs)
 
-    # Get frame chunks to extract
+    # Get frame chunks to extract; batches are generated lazily as the extraction consumes them
     frame_batches = gen_batch_sequence(
         last_frame_idx,
         config_data["chunk_size"],
         config_data["chunk_overlap"],
         offset=first_frame_idx,
     )
+    n_batches = count_batches(
+        last_frame_idx,
+        config_data["chunk_size"],
+        config_data["chunk_overlap"],
+        offset=first_frame_idx,
+    )
 
     # set up the output directory
     if output_dir is None:
@@ -464,8 +471,7 @@ def extract_wrapper(input_file, output_dir, config_data, num_frames=None, skip=F
         if in_dirname not in output_dir:
             output_dir = join(in_dirname, output_dir)
 
-    if not exists(output_dir):
-        os.makedirs(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
 
     # Ensure index is int
     if isinstance(config_data["bg_roi_index"], list):
@@ -516,6 +522,7 @@ def extract_wrapper(input_file, output_dir, config_data, num_frames=None, skip=F
         "last_frame_idx": last_frame_idx,
         "nframes": total_frames,
         "frame_batches": frame_batches,
+        "n_batches": n_batches,
     }
 
     # farm out the batches and write to an hdf5 file
@@ -606,8 +613,7 @@ def flip_file_wrapper(config_file, output_dir, selected_flip=None):
             print("Please enter a valid number listed above")
             continue
 
-    if not exists(output_dir):
-        os.makedirs(output_dir)
+    os.makedirs(output_dir, exist_ok=True)
 
     selection = flip_files[selected_flip]
 
@@ -651,7 +657,8 @@ def convert_raw_to_avi_wrapper(
         output_file = join(dirname(input_file), f"{base_filename}.avi")
 
     vid_info = get_movie_info(input_file, mapping=mapping)
-    frame_batches = gen_batch_sequence(vid_info["nframes"], chunk_size, 0)
+    # iterated twice: once to encode and once to check the encoded frames
+    frame_batches = list(gen_batch_sequence(vid_info["nframes"], chunk_size, 0))
     video_pipe = None
 
     for batch in tqdm(frame_batches, desc="Encoding batches"):
@@ -719,7 +726,8 @@ def copy_slice_wrapper(
     nframes = copy_slice[1] - copy_slice[0]
     offset = copy_slice[0]
 
-    frame_batches = gen_batch_sequence(nframes, chunk_size, 0, offset)
+    # iterated twice: once to encode and once to check the encoded frames
+    frame_batches = list(gen_batch_sequence(nframes, chunk_size, 0, offset))
     video_pipe = None
 
     if exists(output_file):
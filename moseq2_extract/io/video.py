@@ -556,17 +556,32 @@ def write_frames_preview(
 
     # scale frames to appropriate depth ranges
     use_cmap = plt.get_cmap(cmap)
+
+    # unsigned integer frames are color-mapped with one lookup into a table computed once per
+    # possible depth value, instead of scaling, clipping and color-mapping every pixel
+    if frames.dtype in (np.uint8, np.uint16):
+        depths = np.arange(np.iinfo(frames.dtype).max + 1, dtype="float32")
+        depths = np.clip((depths - depth_min) / (depth_max - depth_min), 0, 1)
+        color_lut = (np.delete(use_cmap(depths), 3, 1) * 255).astype("uint8")
+    else:
+        color_lut = None
+
     for i in tqdm(
         range(frames.shape[0]),
         disable=not progress_bar,
         desc=f"Writing frames to {filename}",
     ):
-        disp_img = frames[i, :].copy().astype("float32")
-        disp_img = (disp_img - depth_min) / (depth_max - depth_min)
-        disp_img[disp_img < 0] = 0
-        disp_img[disp_img > 1] = 1
-        disp_img = np.delete(use_cmap(disp_img), 3, 2) * 255
+        if color_lut is not None:
+            disp_img = color_lut[frames[i]]
+        else:
+            disp_img = frames[i].astype("float32")
+            disp_img = (disp_img - depth_min) / (depth_max - depth_min)
+            disp_img[disp_img < 0] = 0
+            disp_img[disp_img > 1] = 1
+            disp_img = np.delete(use_cmap(disp_img), 3, 2) * 255
         if frame_range is not None:
+            # opencv only anti-aliases text on 8-bit images, so the frame number is smoothed on
+            # lookup-table frames (uint8) and drawn without anti-aliasing on the float path
             try:
                 cv2.putText(
                     disp_img,
@@ -583,7 +598,7 @@ def write_frames_preview(
                 # txt_pos is outside of the frame dimensions
                 print("Could not overlay frame number on preview on video.")
 
-        pipe.stdin.write(disp_img.astype("uint8").tostring())
+        pipe.stdin.write(disp_img.astype("uint8", copy=False).tostring())
 
     if close_pipe:
         pipe.communicate()
@@ -600,7 +615,7 @@ def load_movie_data(
 
     Args:
     filename (str): Path to video.
-    frames (int or list): Frame indices to read in to output array.
+    frames (int, list or range): Frame indices to read in to output array.
     frame_size (tuple): Video dimensions (nrows, ncols)
     bit_depth (int): Number of bits per pixel, corresponds to image resolution.
     kwargs (dict): Any additional parameters that could be required in read_frames_raw().
@@ -8,6 +8,7 @@ import math
 import json
 import h5py
 import click
+import hdf5plugin  # noqa: F401 registers the Blosc filter used to read extracted h5 files
 import tarfile
 import warnings
 import numpy as np
@@ -15,6 +16,7 @@ from glob import glob
 from copy import deepcopy
 import ruamel.yaml as yaml
 from typing import Pattern
+from functools import lru_cache
 from cytoolz import valmap
 from moseq2_extract.io.image import write_image
 from moseq2_extract.io.video import get_movie_info
@@ -169,15 +171,29 @@ def gen_batch_sequence(nframes, chunk_size, overlap, offset=0):
     overlap (int): number of overlapping frames
     offset (int): frame offset
 
-    Returns:
-    out (list): the list of batches
+    Yields:
+    batch (range): frame indices of the next batch
     """
 
     seq = range(offset, nframes)
-    out = []
     for i in range(0, len(seq) - overlap, chunk_size - overlap):
-        out.append(seq[i:i + chunk_size])
-    return out
+        yield seq[i:i + chunk_size]
+
+def count_batches(nframes, chunk_size, overlap, offset=0):
+    """
+    Counts the batches gen_batch_sequence() yields for the same arguments, without generating them.
+
+    Args:
+    nframes (int): total number of frames
+    chunk_size (int): the number of desired chunk size
+    overlap (int): number of overlapping frames
+    offset (int): frame offset
+
+    Returns:
+    n_batches (int): number of batches
+    """
+
+    return len(range(0, len(range(offset, nframes)) - overlap, chunk_size - overlap))
 
 def load_timestamps(timestamp_file, col=0, alternate=False):
     """
@@ -322,7 +338,8 @@ def detect_and_set_camera_parameters(config_data, input_file=None):
 
 def check_filter_sizes(config_data):
     """
-    Ensure spatial and temporal filter kernel sizes are odd numbers.
+    Ensure spatial and temporal filter kernel sizes are odd numbers, and that the
+    filter and crop sizes are ints.
 
     Args:
     config_data (dict): a dictionary holding all extraction parameters
@@ -332,6 +349,13 @@ def check_filter_sizes(config_data):
 
     """
 
+    # click passes multiple=True options as tuples and yaml can hold floats or strings;
+    # coerce them so the sizes can be incremented below and reach numpy/opencv as ints
+    for key in ('spatial_filter_size', 'temporal_filter_size'):
+        config_data[key] = [int(s) for s in config_data[key]]
+    if 'crop_size' in config_data:
+        config_data['crop_size'] = [int(s) for s in config_data['crop_size']]
+
     # Ensure filter kernel sizes are odd
     if config_data['spatial_filter_size'][0] % 2 == 0 and config_data['spatial_filter_size'][0] > 0:
         warnings.warn("Spatial Filter Size must be an odd number. Incrementing value by 1.")
@@ -438,12 +462,27 @@ def select_strel(string='e', size=(10, 10)):
     strel (cv2.StructuringElement): selected cv2 StructuringElement to use in video filtering or ROI dilation/erosion.
     """
 
-    if string[0].lower() == 'e':
-        strel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, size)
-    elif string[0].lower() == 'r':
+    return _cached_strel(string[0].lower(), tuple(int(s) for s in size))
+
+@lru_cache(maxsize=None)
+def _cached_strel(shape, size):
+    """
+    Builds a structuring element once per (shape, size) pair; later calls reuse it.
+    The returned array is read-only since it is shared between callers.
+
+    Args:
+    shape (str): 'e' for ellipse, 'r' for rectangle, anything else falls back to ellipse
+    size (tuple): size of structuring element
+
+    Returns:
+    strel (cv2.StructuringElement): read-only structuring element.
+    """
+
+    if shape == 'r':
         strel = cv2.getStructuringElement(cv2.MORPH_RECT, size)
     else:
         strel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, size)
+    strel.setflags(write=False)
 
     return strel
 
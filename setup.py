@@ -43,8 +43,8 @@ setup(
     install_requires=['h5py==2.10.0', 'tqdm>=4.48.0', 'scipy==1.3.2', 'numpy==1.18.3', 'click==7.0',
                       'joblib==0.15.1', 'cytoolz==0.10.1', 'matplotlib==3.1.2', 'statsmodels==0.10.2',
                       'scikit-image==0.16.2', 'scikit-learn==0.20.3', 'opencv-python==4.1.2.30',
-                      'ruamel.yaml==0.16.5'],
-    python_requires='>=3.6,<3.8',
+                      'ruamel.yaml==0.16.5', 'hdf5plugin>=2.0.0', 'numba==0.50.1', 'blosc>=1.9.0'],
+    python_requires='>=3.7,<3.8',
     entry_points={'console_scripts': ['moseq2-extract = moseq2_extract.cli:cli']},
     extras_require={
         "docs": [
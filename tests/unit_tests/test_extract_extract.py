@@ -0,0 +1,46 @@
+import cv2
+import numpy as np
+import numpy.testing as npt
+from unittest import TestCase
+from numpy.lib.recfunctions import structured_to_unstructured
+from moseq2_extract.extract.extract import extract_chunk
+
+
+def make_fake_chunk(nframes=30):
+    # a 700 mm deep floor with an elliptical mouse moving and turning on it
+    rng = np.random.default_rng(0)
+    bground = np.full((200, 220), 700.0) + rng.normal(0, 1, (200, 220))
+    chunk = np.tile(bground, (nframes, 1, 1)).astype("uint16")
+    for i in range(nframes):
+        center = (80 + i % 30, 90 + i % 20)
+        mouse = cv2.ellipse(np.zeros((200, 220), "uint8"), center, (25, 10), i * 3, 0, 360, 1, -1)
+        chunk[i][mouse > 0] -= 30 + i % 10
+
+    roi = np.zeros((200, 220), "uint8")
+    roi[10:190, 12:200] = 1
+
+    return chunk, bground, roi
+
+
+class TestExtractExtract(TestCase):
+
+    def test_extract_chunk_tiles(self):
+
+        chunk, bground, roi = make_fake_chunk()
+
+        for params in [{}, {"graduate_walls": True}, {"temporal_filter_size": (3,)}]:
+            params = dict(
+                bground=bground, roi=roi, true_depth=690.0, progress_bar=False, **params
+            )
+
+            # one tile holding the whole chunk vs. tiles that don't divide it evenly
+            untiled = extract_chunk(chunk.copy(), tile_size=len(chunk), **params)
+            tiled = extract_chunk(chunk.copy(), tile_size=7, **params)
+
+            assert untiled["depth_frames"].any(), "fake mouse was not extracted"
+            for key in ("chunk", "depth_frames", "mask_frames"):
+                npt.assert_array_equal(untiled[key], tiled[key])
+            npt.assert_array_equal(
+                structured_to_unstructured(untiled["scalars"]),
+                structured_to_unstructured(tiled["scalars"]),
+            )
@@ -14,6 +14,10 @@ from moseq2_extract.extract.proc import (
     compute_scalars,
     clean_frames,
     get_largest_cc,
+    preprocess_chunk,
+    nanmedian_frames,
+    threshold_chunk,
+    apply_roi,
     feature_hampel_filter,
 )
 
@@ -207,6 +211,80 @@ class TestExtractProc(TestCase):
         fake_movie = np.tile(fake_mouse, (100, 1, 1))
         cleaned_fake_movie = clean_frames(fake_movie, prefilter_time=(3,))
 
+    def test_nanmedian_frames(self):
+
+        rng = np.random.default_rng(0)
+
+        # odd and even numbers of valid values per pixel, and one pixel that is always NaN
+        frames = rng.uniform(0, 1000, size=(10, 30, 40))
+        frames[rng.random(frames.shape) < 0.2] = np.nan
+        frames[:, 3, 4] = np.nan
+
+        median = nanmedian_frames(frames)
+        assert np.isnan(median[3, 4])
+        npt.assert_array_equal(median, np.nanmedian(frames, axis=0))
+
+        depth_frames = rng.integers(600, 800, size=(11, 30, 40)).astype("uint16")
+        npt.assert_array_equal(nanmedian_frames(depth_frames), np.median(depth_frames, axis=0))
+
+        # numpy averages float32 middle values in float32
+        frames = frames.astype("float32")
+        npt.assert_allclose(nanmedian_frames(frames), np.nanmedian(frames, axis=0), rtol=1e-6)
+
+    def test_threshold_chunk(self):
+
+        rng = np.random.default_rng(0)
+
+        # dtypes OpenCV handles natively and ones that fall back to numpy
+        for dtype in ("uint8", "int16", "uint16", "int32", "int64", "uint32", "float16", "float32", "float64"):
+            chunk = rng.integers(0, 150, size=(5, 20, 30)).astype(dtype)
+            original = chunk.copy()
+
+            expected = chunk.copy()
+            expected[expected < 10] = 0
+            expected[expected > 100] = 0
+
+            out = threshold_chunk(chunk, 10, 100)
+            assert out.dtype == chunk.dtype, dtype
+            npt.assert_array_equal(out, expected)
+            npt.assert_array_equal(chunk, original)
+
+        chunk = np.full((2, 3, 4), 50.0)
+        chunk[0, 1, 2] = np.nan
+        out = threshold_chunk(chunk, 10, 100)
+        assert out[0, 1, 2] == 0
+        assert np.isnan(chunk[0, 1, 2])
+
+    def test_preprocess_chunk(self):
+
+        rng = np.random.default_rng(0)
+        bground = rng.uniform(690, 710, size=(60, 70))
+        roi = np.zeros((60, 70), "uint8")
+        roi[10:50, 5:60] = 1
+        roi[20, 20] = 0
+
+        # heights between 0 and 255 go through the uint8 cast unchanged
+        chunk = (bground - rng.uniform(0, 250, size=(8, 60, 70))).astype("int16")
+        chunk[:, 30, 30] = 0
+
+        # previous numpy chain: subtract, cast, threshold, mask and crop to the ROI
+        expected = ((bground - chunk) * (chunk != 0)).astype("uint8")
+        expected = apply_roi(threshold_chunk(expected, 10, 100), roi)
+
+        out = preprocess_chunk(chunk, bground, roi, min_height=10, max_height=100)
+        assert out.dtype == np.uint8
+        npt.assert_array_equal(out, expected)
+
+        # pixels with no depth reading, pixels outside the ROI and heights that used to wrap
+        # around in the uint8 cast (297 -> 41) are all zeroed
+        chunk[:, 15, 15] = np.floor(bground[15, 15]) - 297
+        assert np.all(((bground - chunk) * (chunk != 0)).astype("uint8")[:, 15, 15] == 41)
+
+        out = preprocess_chunk(chunk, bground, roi, min_height=10, max_height=100)
+        assert np.all(out[:, 30 - 10, 30 - 5] == 0)
+        assert np.all(out[:, 20 - 10, 20 - 5] == 0)
+        assert np.all(out[:, 15 - 10, 15 - 5] == 0)
+
     def test_feature_hampel_filter(self):
 
         fake_mouse = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (30, 20))
@@ -5,20 +5,81 @@ import uuid
 import shutil
 import numpy as np
 from copy import deepcopy
+import moseq2_extract.helpers.extract
 import ruamel.yaml as yaml
-from unittest import TestCase
+from unittest import TestCase, mock
 from moseq2_extract.io.image import read_image
-from moseq2_extract.helpers.data import create_extract_h5
+from moseq2_extract.helpers.data import create_extract_h5, blosc_compression
 from ..integration_tests.test_cli import write_fake_movie
 from moseq2_extract.gui import generate_config_command, download_flip_command
-from moseq2_extract.util import scalar_attributes, gen_batch_sequence, load_metadata
+from moseq2_extract.util import (
+    scalar_attributes,
+    gen_batch_sequence,
+    load_metadata,
+    read_yaml,
+    get_strels,
+    check_filter_sizes,
+)
 from moseq2_extract.helpers.extract import (
     run_local_extract,
     process_extract_batches,
+    get_extract_datasets,
+    write_batch_to_dataset,
     write_extracted_chunk_to_h5,
 )
 
 
+def setup_fake_extraction(data_dir, chunk_size=4):
+    """
+    Write a fake depth movie and build the default extraction parameters for it.
+    """
+
+    if not os.path.isdir(data_dir):
+        os.makedirs(data_dir)
+
+    data_file = os.path.join(data_dir, "depth.dat")
+    write_fake_movie(data_file)
+
+    config_path = os.path.join(data_dir, "config.yaml")
+    generate_config_command(config_path)
+    config_data = check_filter_sizes(read_yaml(config_path))
+    config_data["chunk_size"] = chunk_size
+    config_data["true_depth"] = 700
+    config_data["flip_classifier"] = None
+    config_data["progress_bar"] = False
+
+    # the fake movie is a 700 mm deep disk floor with a mouse on it, 1000 mm elsewhere
+    bground_im = np.full((424, 512), 700, "float32")
+    roi = cv2.circle(np.zeros((424, 512), "uint8"), (256, 212), 140, 1, -1)
+
+    return data_file, config_data, bground_im, roi, get_strels(config_data)
+
+
+def create_test_datasets(h5_file, config_data, nframes):
+    """
+    Create the datasets process_extract_batches() writes to.
+    """
+
+    nscalars = len(scalar_attributes())
+    crop_size = tuple(config_data["crop_size"])
+    chunk_rows = config_data["chunk_size"]
+    h5_file.create_dataset(
+        "packed_scalars",
+        (nframes, nscalars),
+        "float32",
+        chunks=(chunk_rows, nscalars),
+        **blosc_compression(),
+    )
+    for name, dtype in [("frames", config_data["frame_dtype"]), ("frames_mask", "bool")]:
+        h5_file.create_dataset(
+            name,
+            (nframes,) + crop_size,
+            dtype,
+            chunks=(chunk_rows,) + crop_size,
+            **blosc_compression(),
+        )
+
+
 class TestHelperExtract(TestCase):
 
     def test_write_extracted_chunk_to_h5(self):
@@ -32,25 +93,120 @@ class TestHelperExtract(TestCase):
         results = {
             "depth_frames": np.zeros((100, 10, 10)),
             "mask_frames": np.zeros((100, 10, 10)),
-            "scalars": {"speed": np.ones((100, 1))},
+            "scalars": np.ones((100,), [("speed", "float32")]),
         }
 
         out_file = os.path.join(output_dir, f"{output_filename}.h5")
 
         with h5py.File(out_file, "w") as f:
-            f.create_dataset(f"scalars/speed", (100, 1), "float32", compression="gzip")
+            f.create_dataset(f"packed_scalars", (100, 1), "float32", compression="gzip")
             f.create_dataset(f"frames", (100, 10, 10), "float32", compression="gzip")
             f.create_dataset(
                 f"frames_mask", (100, 10, 10), "float32", compression="gzip"
             )
 
+            h5_datasets = get_extract_datasets(f, config_data)
             write_extracted_chunk_to_h5(
-                f, results, config_data, scalars, frame_range, offset
+                h5_datasets, results, config_data, scalars, frame_range, offset
             )
 
+            np.testing.assert_array_equal(f["packed_scalars"][:, 0], 1)
+
         assert os.path.exists(out_file)
         os.remove(out_file)
 
+    def test_write_batch_to_dataset(self):
+
+        out_file = "data/test_direct_chunks.h5"
+        frames = np.random.randint(0, 255, size=(25, 10, 10)).astype("uint8")
+        mask = frames > 100
+
+        with h5py.File(out_file, "w") as f:
+            f.create_dataset(
+                "frames", (25, 10, 10), "uint8", chunks=(10, 10, 10), **blosc_compression()
+            )
+            f.create_dataset(
+                "mask", (25, 10, 10), "bool", chunks=(10, 10, 10), **blosc_compression()
+            )
+
+            # chunk-aligned batches, the last one partial, then a misaligned overwrite
+            for batch in (range(0, 10), range(10, 20), range(20, 25)):
+                write_batch_to_dataset(f["frames"], batch, frames[batch])
+                write_batch_to_dataset(f["mask"], batch, mask[batch])
+            write_batch_to_dataset(f["frames"], range(5, 15), frames[5:15] // 2)
+            frames[5:15] //= 2
+
+        with h5py.File(out_file, "r") as f:
+            np.testing.assert_array_equal(f["frames"][()], frames)
+            np.testing.assert_array_equal(f["mask"][()], mask)
+
+        os.remove(out_file)
+
+    def test_process_extract_batches_in_parallel(self):
+
+        data_dir = "data/test_parallel_extract/"
+        data_file, config_data, bground_im, roi, str_els = setup_fake_extraction(data_dir)
+        nframes = 20
+
+        outputs = []
+        for num_workers in (1, 2):
+            config_data["num_workers"] = num_workers
+            out_file = os.path.join(data_dir, f"test_out_{num_workers}.h5")
+            with h5py.File(out_file, "w") as f:
+                create_test_datasets(f, config_data, nframes)
+                process_extract_batches(
+                    data_file,
+                    deepcopy(config_data),
+                    bground_im,
+                    roi,
+                    gen_batch_sequence(nframes, config_data["chunk_size"], 0),
+                    str_els,
+                    os.path.join(data_dir, f"test_out_{num_workers}.mp4"),
+                    scalars=list(scalar_attributes()),
+                    h5_file=f,
+                    n_batches=5,
+                )
+            with h5py.File(out_file, "r") as f:
+                outputs.append({key: f[key][()] for key in f.keys()})
+
+        serial, parallel = outputs
+        assert serial["frames"].any(), "fake mouse was not extracted"
+        for key in ("packed_scalars", "frames", "frames_mask"):
+            np.testing.assert_array_equal(serial[key], parallel[key])
+
+        shutil.rmtree(data_dir)
+
+    def test_process_extract_batches_writer_error(self):
+
+        data_dir = "data/test_writer_error/"
+        data_file, config_data, bground_im, roi, str_els = setup_fake_extraction(
+            data_dir, chunk_size=2
+        )
+        frame_batches = list(gen_batch_sequence(20, 2, 0))
+
+        extract_chunk = mock.Mock(
+            wraps=moseq2_extract.helpers.extract.extract_chunk
+        )
+        with mock.patch(
+            "moseq2_extract.helpers.extract.write_frames_preview",
+            side_effect=RuntimeError("preview failed"),
+        ), mock.patch("moseq2_extract.helpers.extract.extract_chunk", extract_chunk):
+            with self.assertRaises(RuntimeError):
+                process_extract_batches(
+                    data_file,
+                    config_data,
+                    bground_im,
+                    roi,
+                    frame_batches,
+                    str_els,
+                    os.path.join(data_dir, "test_out.mp4"),
+                    scalars=list(scalar_attributes()),
+                )
+
+        # the extraction stops soon after the writer fails instead of running every batch
+        assert extract_chunk.call_count < len(frame_batches)
+        shutil.rmtree(data_dir)
+
     def test_process_extract_batches(self):
 
         output_dir = "data/"
@@ -13,6 +13,7 @@ from moseq2_extract.io.image import read_image
 from ..integration_tests.test_cli import write_fake_movie
 from moseq2_extract.util import (
     gen_batch_sequence,
+    count_batches,
     load_metadata,
     load_timestamps,
     recursive_find_unextracted_dirs,
@@ -22,6 +23,7 @@ from moseq2_extract.util import (
     click_param_annot,
     strided_app,
     get_strels,
+    check_filter_sizes,
     get_bucket_center,
     make_gradient,
     graduate_dilated_wall_area,
@@ -97,6 +99,22 @@ class TestExtractUtils(TestCase):
 
         assert list(test_strel_out.keys()) == out_keys
 
+    def test_check_filter_sizes(self):
+
+        # click hands multiple=True options over as tuples
+        config_data = {
+            "spatial_filter_size": (4,),
+            "temporal_filter_size": (0,),
+            "crop_size": ("80", 80.0),
+        }
+
+        with self.assertWarns(UserWarning):
+            config_data = check_filter_sizes(config_data)
+
+        assert config_data["spatial_filter_size"] == [5]
+        assert config_data["temporal_filter_size"] == [0]
+        assert config_data["crop_size"] == [80, 80]
+
     def test_read_yaml(self):
 
         test_file = "data/config.yaml"
@@ -141,6 +159,9 @@ class TestExtractUtils(TestCase):
 
         assert gen_list == tmp_list
 
+        for args in [(25, 10, 5), (25, 10, 0), (3, 10, 5), (100, 7, 2, 13)]:
+            assert count_batches(*args) == len(list(gen_batch_sequence(*args)))
+
     def test_load_timestamps(self):
 
         txt_path = "data/tmp_timestamps.txt"
@@ -190,6 +211,9 @@ class TestExtractUtils(TestCase):
         strel = select_strel("sdfdfsf", size=(9, 9))
         npt.assert_equal(strel, cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (9, 9)))
 
+        # elements are cached per shape and size
+        assert select_strel("ellipse", size=(9, 9)) is select_strel("e", size=[9, 9])
+
     def test_scalar_attributes(self):
 
         dct = scalar_attributes()